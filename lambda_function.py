@@ -1,152 +1,419 @@
+import concurrent.futures
 import json
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from s3transfer.manager import TransferManager
+from s3transfer.subscribers import BaseSubscriber
 import os
 
+# RE2 matches in linear time on a DFA with no backtracking. Use it for the
+# filename patterns when the google-re2 wheel is bundled, otherwise stdlib re.
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+# orjson parses and serialises several times faster than the stdlib; fall back
+# to json where its wheels aren't available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
 # The full prompt, which acts as the core instruction set for the LLM.
 # It is defined globally to be initialized only once per Lambda execution environment.
 prompt_template = """
-Instruction:
-You are a highly reliable and expert file path transformation system. Your sole task is to analyze a source file name and folder path, extract key information, and then format it into a new target file path and name. You must provide your output in a strict JSON format.
-Input:
-Source File Name: SAM_<<study_name>>_<<env>>_<<dataset>>_<<blinded/unblinded>>_<<vendor>>_yyyymmdd.csv
-Source File Path: samprod-fileingestion/<<study_name>>/
-Output:
-Expected file format: <<blinded>>_<<dataset>>_yyyymmdd.csv
-Expected file location: rtft/<<study_name>>/<<vendor>>/
-Core Extraction Logic
-Follow these steps to extract the necessary components from the input:
-Date and Month Conversion: If the date in the file name is in the format YYYYMMMDD (e.g., 2023APR18), convert the three-letter month abbreviation to its two-digit numeric format (e.g., APR -> 04). The final date format should always be YYYYMMDD (e.g., 20230418). The date is typically located before the file extension.
-Identify Study Name: Find the study code, which is a string that appears in both the file name and the source folder path (e.g., P23-380). This is typically found after SAM_ and before the environment (e.g., TEST, PROD).
-Identify Blinding Status: Look for the keywords BLINDED or UNBLINDED.
-Identify Dataset Name: This is the key piece of information that describes the file's content.
-For SAM files, the dataset is typically found after the env segment and before the blinding status. It can be a single word (e.g., TV) or a code (e.g., RNKIT).
-If you cannot confidently identify the dataset, use unknowndataset as the placeholder.
-Identify Vendor: Look for a vendor name (vendorname), which is often a company or lab name like UC lab or EPC, typically found before the date. If a vendor name is not present in the file name, use unknownvendor as the placeholder.
-Extract Extension: Extract the file extension (e.g., .csv, .txt, .pdf).
-
-If place are interchanged try identifying it, this is example of each component:
-study_name:B15-845,ABT-199,M24-064
-env: TEST or PROD
-Dataset: DA,RNKIT,MAGEINV
-blinded/unblinded:blinded,unblinded
-Vendor: UC lab,LBC,EPC,ABBV
-Transformation Rules
-Use the extracted components to build the target path and file name.
-Rule A (Default Case): For files starting with SAM_, the Target File Name should be [blinding status]_[dataset]_[converted date].[extension]. The Target File Path should be rtft/[study name]/[vendor name]/.
-Rule B (Special Case/General Fallback): For all other files, the Target File Name is the original Source File Name. The Target File Path should be rtft/[study name]/[vendor name]/ if both can be identified. If only the study name is identified, the path should be rtft/[study name]/unknownvendor/. If neither can be identified, the path should be rtft/unknownstudy/unknownvendor/.
-Example Walkthroughs
-Example 1 (Default Case):
-Input:
-Source File Name: SAM_P23-380_TEST_TV_BLINDED_UC lab_20231030.csv
-Source File Path: samprod-fileingestion/P23-380/
+Convert a source file into a JSON object with "Target File Name" and "Target File Path".
+SAM_<study>_<env>_<dataset>_<BLINDED|UNBLINDED>_<vendor>_<date>.<ext> (fields may be out of order) becomes <blinding>_<dataset>_<yyyymmdd>.<ext> in rtft/<study>/<vendor>/; convert dates like 2023APR18 to 20230418 and use unknowndataset or unknownvendor when missing. Other files keep their name in rtft/<study from path>/<vendor>/, or rtft/unknownstudy/unknownvendor/.
+Known values: study B15-845, ABT-199, M24-064; env TEST, PROD; dataset DA, RNKIT, MAGEINV; vendor UC lab, LBC, EPC, ABBV.
+Input: SAM_P23-380_TEST_TV_BLINDED_UC lab_20231030.csv, samprod-fileingestion/P23-380/
 Output: {"Target File Name": "BLINDED_TV_20231030.csv", "Target File Path": "rtft/P23-380/UC lab/"}
-Example 2 (Date Conversion Case):
-Input:
-Source File Name: SAM_Mock Study 34_TEST_RNKIT_UNBLINDED_EPC_2023APR18.txt
-Source File Path: samprod-fileingestion/Mock Study 34/
+Input: SAM_Mock Study 34_TEST_RNKIT_UNBLINDED_EPC_2023APR18.txt, samprod-fileingestion/Mock Study 34/
 Output: {"Target File Name": "UNBLINDED_RNKIT_20230418.txt", "Target File Path": "rtft/Mock Study 34/EPC/"}
-Example 3 (Fallback Case):
-Input:
-Source File Name: my_report.pdf
-Source File Path: samprod-fileingestion/Mock Study 33/
-Output: {"Target File Name": "my_report.pdf", "Target File Path": "rtft/Mock Study 33/unknownvendor/"}
-Example 4 (Unknown Case):
-Input:
-Source File Name: another_report.docx
-Source File Path: miscellaneous/
-Output: {"Target File Name": "another_report.docx", "Target File Path": "rtft/unknownstudy/unknownvendor/"}
-
-Final Output Format
-Provide only a single JSON object with the following structure. Do not include any additional text, explanations, or code outside of the JSON.
-JSON
-
-{
-  "Target File Name": "[constructed_file_name]",
-  "Target File Path": "[constructed_file_path]"
+Return only JSON, with no other text.
+"""
+
+# Appended to the prompt when several files are resolved in one request
+batch_instructions = """
+Batch mode: the Input is a JSON array of {"name", "path"} objects. Return only a JSON array with one output object per input, in the same order.
+"""
+
+# The static part of the prompt is joined once, so each call only adds the inputs
+PROMPT_PREFIX = f"{prompt_template}\n{batch_instructions}\nInput:\n"
+PROMPT_SUFFIX = "\nOutput:"
+
+# Grammar of well-formed ingestion files:
+# SAM_<study>_<env>_<dataset>_<blinding>_<vendor>_<date>.<ext>
+SAM_PATTERN = re.compile(
+    r'^SAM_(?P<study>.+?)_(?:TEST|PROD)_(?P<dataset>[^_]+)_(?P<blinding>BLINDED|UNBLINDED)'
+    r'_(?P<vendor>.+?)_(?P<date>\d{4}(?:[A-Z]{3}|\d{2})\d{2})\.(?P<ext>.+)$'
+)
+
+MONTHS = {
+    'JAN': '01', 'FEB': '02', 'MAR': '03', 'APR': '04', 'MAY': '05', 'JUN': '06',
+    'JUL': '07', 'AUG': '08', 'SEP': '09', 'OCT': '10', 'NOV': '11', 'DEC': '12',
 }
 
+# Known component values, used to pick fields out of names that don't follow the grammar
+STUDY_TOKENS = re.compile(r'(B15-845|ABT-199|M24-064|P23-380)')
+DATASET_TOKENS = re.compile(r'(?:^|_)(DA|RNKIT|MAGEINV|TV)(?:_|\.|$)')
+BLINDING_TOKENS = re.compile(r'(?i)(?:^|_)(UNBLINDED|BLINDED)(?:_|\.|$)')
+VENDOR_TOKENS = re.compile(r'(?:^|_)(UC lab|LBC|EPC|ABBV)(?:_|\.|$)')
+DATE_TOKENS = re.compile(r'(?:^|_)(\d{4}(?:[A-Za-z]{3}|\d{2})\d{2})(?:_|\.|$)')
 
-"""
 
-# Initialize clients outside the handler to reuse them across invocations
-sqs_client = boto3.client('sqs')
-s3_client = boto3.client('s3')
-bedrock_client = boto3.client('bedrock-runtime', region_name='ap-south-1')
+def convert_date(date):
+    # 2023APR18 -> 20230418; dates already in YYYYMMDD pass through
+    month = date[4:-2]
+    if month.isalpha():
+        month = MONTHS.get(month.upper())
+        if month is None:
+            return None
+    return date[:4] + month + date[-2:]
 
-def lambda_handler(event, context):
+
+def find_token(pattern, text):
+    match = pattern.search(text)
+    return match.group(1) if match else None
+
+
+def build_target(file_name, study, vendor):
+    return {
+        "Target File Name": file_name,
+        "Target File Path": f"rtft/{study or 'unknownstudy'}/{vendor or 'unknownvendor'}/"
+    }
+
+
+def find_study(source_file_name, source_file_path):
+    # The study folder in the source path, otherwise a known study code in the name
+    head, _, folder = source_file_path.rstrip('/').rpartition('/')
+    return (folder if head else None) or find_token(STUDY_TOKENS, source_file_name)
+
+
+def transform(source_file_name, source_file_path):
+    """Map a source file to its target name and path without calling the LLM.
+
+    Returns a dict shaped like the LLM output, or None for a SAM_ file whose
+    blinding status, date or extension can't be found, which is left to Bedrock.
+    """
+    # Anything that isn't a SAM_ file keeps its name under the fallback rule, so
+    # skip the SAM_ grammar and field searches entirely
+    if not source_file_name.startswith('SAM_'):
+        return build_target(
+            source_file_name,
+            find_study(source_file_name, source_file_path),
+            find_token(VENDOR_TOKENS, source_file_name)
+        )
+
+    match = SAM_PATTERN.match(source_file_name)
+    if match:
+        date = convert_date(match.group('date'))
+        if date:
+            return build_target(
+                f"{match.group('blinding')}_{match.group('dataset')}_{date}.{match.group('ext')}",
+                match.group('study'),
+                match.group('vendor')
+            )
+
+    # Fields are missing or out of order: search for the known values instead
+    blinding = find_token(BLINDING_TOKENS, source_file_name)
+    date = find_token(DATE_TOKENS, source_file_name)
+    date = convert_date(date) if date else None
+    # With more than one dot there's no telling where the extension starts
+    # (e.g. .tar.gz), so leave those to Bedrock rather than drop part of it
+    if not (blinding and date) or source_file_name.count('.') != 1:
+        return None
+    ext = source_file_name.rpartition('.')[2]
+    dataset = find_token(DATASET_TOKENS, source_file_name) or 'unknowndataset'
+    return build_target(
+        f"{blinding.upper()}_{dataset}_{date}.{ext}",
+        find_study(source_file_name, source_file_path),
+        find_token(VENDOR_TOKENS, source_file_name)
+    )
+
+# Clients are created on first use and reused across invocations. Building one
+# loads its botocore service model, so Bedrock is only paid for when it's needed.
+sqs_client = None
+s3_client = None
+transfer_manager = None
+bedrock_client = None
+
+# Sized for the concurrent copy step, with keep-alive so pooled TLS connections get reused
+client_config = Config(
+    max_pool_connections=64,
+    retries={'mode': 'adaptive', 'max_attempts': 3},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=10
+)
+
+# Small objects are copied with a single CopyObject; past the threshold the
+# transfer manager switches to a parallel multipart copy (UploadPartCopy)
+transfer_config = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=16
+)
+
+class ProvideSizeSubscriber(BaseSubscriber):
+    """Hands the object size (and ETag) from the S3 event to the transfer manager,
+    so a single-request copy doesn't need a HeadObject first."""
+
+    def __init__(self, size, etag=None):
+        self.size = size
+        self.etag = etag
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+        # Older s3transfer releases don't track the ETag
+        if self.etag and hasattr(future.meta, 'provide_object_etag'):
+            future.meta.provide_object_etag(self.etag)
+
+def init_clients():
+    global sqs_client, s3_client, transfer_manager
+    if sqs_client is None:
+        sqs_client = boto3.client('sqs', config=client_config)
+    if s3_client is None:
+        s3_client = boto3.client('s3', config=client_config)
+    if transfer_manager is None:
+        transfer_manager = TransferManager(s3_client, transfer_config)
+
+def get_bedrock_client():
+    global bedrock_client
+    if bedrock_client is None:
+        # Generating text takes longer than the S3/SQS calls, so allow a longer read
+        bedrock_client = boto3.client(
+            'bedrock-runtime',
+            region_name='ap-south-1',
+            config=client_config.merge(Config(read_timeout=60))
+        )
+    return bedrock_client
+
+# Shared by the copy step; botocore clients are thread-safe
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+
+# Validate required environment variables once, so a misconfigured function
+# fails its cold start instead of every invocation
+required_env_vars = ['SQS_QUEUE_NAME', 'DESTINATION_BUCKET_NAME']
+missing_vars = [var for var in required_env_vars if not os.environ.get(var, '').strip()]
+if missing_vars:
+    raise RuntimeError(f"Missing required environment variables: {', '.join(missing_vars)}")
+
+# Strip whitespace from the queue and bucket names to avoid invalid name errors
+SQS_QUEUE_NAME = os.environ['SQS_QUEUE_NAME'].strip()
+DESTINATION_BUCKET = os.environ['DESTINATION_BUCKET_NAME'].strip()
+
+# Looked up by the first invocation, and retried by later ones if that fails
+SQS_QUEUE_URL = None
+
+# With SnapStart, init runs once per published version and is restored from a
+# snapshot on cold start, so build the clients and resolve the queue URL here
+# instead of on the first invocation. A failed lookup is left to the handler.
+if os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'snap-start':
+    init_clients()
     try:
-        sqs_queue_url = sqs_client.get_queue_url(QueueName=os.environ['SQS_QUEUE_NAME'])['QueueUrl']
+        SQS_QUEUE_URL = sqs_client.get_queue_url(QueueName=SQS_QUEUE_NAME)['QueueUrl']
     except Exception as e:
-        print(f"Error getting SQS Queue URL: {e}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps('SQS queue URL not found.')
+        print(f"Error getting SQS Queue URL during init: {e}")
+
+def extract_json(text):
+    """Parse the first complete JSON array or object in the LLM output.
+
+    One left-to-right pass tracks bracket depth, ignoring brackets inside string
+    values, so text or stray braces after the JSON don't break parsing.
+    """
+    start = None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c in '[{':
+            if start is None:
+                start = i
+            depth += 1
+        elif start is None:
+            continue
+        elif c == '"':
+            in_string = True
+        elif c in ']}':
+            depth -= 1
+            if depth == 0:
+                return json_loads(text[start:i + 1])
+    raise ValueError(f"No complete JSON found in LLM output: {text[:200]}")
+
+def transform_batch_with_llm(files):
+    """Resolve several (source_file_name, source_file_path) pairs with one Bedrock call.
+
+    Returns the target dicts in the same order as files.
+    """
+    inputs = [{"name": name, "path": path} for name, path in files]
+
+    # Construct the final prompt for the LLM
+    full_prompt = "".join((PROMPT_PREFIX, json_dumps(inputs), PROMPT_SUFFIX))
+
+    body = json_dumps({
+        "inputText": full_prompt,
+        "textGenerationConfig": {
+            # Each target is ~60-80 tokens
+            "maxTokenCount": 96 * len(files),
+            "temperature": 0,
+            "topP": 1,
         }
+    })
+
+    response = get_bedrock_client().invoke_model(
+        body=body,
+        modelId="amazon.titan-text-express-v1",
+        accept="application/json",
+        contentType="application/json"
+    )
+
+    response_body = json_loads(response.get('body').read())
+    llm_output_text = response_body.get('results')[0].get('outputText')
+
+    # Isolate and parse the JSON array from the LLM output
+    targets = extract_json(llm_output_text)
+    # A lone object or a short list would otherwise be zipped against the wrong files
+    if not isinstance(targets, list) or len(targets) != len(files):
+        raise ValueError(f"Expected a list of {len(files)} transformations from Bedrock, got: {json_dumps(targets)}")
+    for target in targets:
+        if not (isinstance(target, dict)
+                and isinstance(target.get('Target File Name'), str)
+                and isinstance(target.get('Target File Path'), str)):
+            raise ValueError(f"Malformed transformation from Bedrock: {json_dumps(target)}")
+    return targets
+
+def process_record(job, target):
+    """Copy one resolved file to the destination bucket.
+
+    Returns (receipt_handle, ok) so the caller can delete the messages that succeeded.
+    """
+    record, source_bucket, source_key, source_object, _, _ = job
+    if target is None:
+        return record['receiptHandle'], False
+    try:
+        target_file_path = target['Target File Path'].replace("rtft/", "")
+        target_file_name = target['Target File Name']
+
+        new_key = target_file_path + target_file_name
+
+        # Keep the source metadata, and only copy the version this event is about
+        extra_args = {'MetadataDirective': 'COPY'}
+        if source_object.get('eTag'):
+            extra_args['CopySourceIfMatch'] = source_object['eTag']
+
+        # Below the threshold the copy is a single CopyObject, so the size from the
+        # event is all it needs. Larger objects are left to s3transfer's own
+        # HeadObject, which supplies the metadata for the multipart upload.
+        source_size = source_object.get('size')
+        subscribers = None
+        if source_size is not None and source_size < transfer_config.multipart_threshold:
+            subscribers = [ProvideSizeSubscriber(source_size, source_object.get('eTag'))]
+
+        transfer_manager.copy(
+            copy_source={'Bucket': source_bucket, 'Key': source_key},
+            bucket=DESTINATION_BUCKET,
+            key=new_key,
+            extra_args=extra_args,
+            subscribers=subscribers
+        ).result()
+
+        print(f"File {source_key} copied to {new_key} in {DESTINATION_BUCKET}")
+        return record['receiptHandle'], True
+
+    except Exception as e:
+        # The source was overwritten after this event; the newer version's own event copies it.
+        # CopyObject reports this as PreconditionFailed, the HeadObject before a multipart copy as a bare 412
+        if isinstance(e, ClientError) and e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 412:
+            print(f"Skipping {source_key}: it changed after this event was sent")
+            return record['receiptHandle'], True
+        print(f"Error processing S3 object {source_key}: {e}")
+        return record['receiptHandle'], False
+
+def delete_messages(sqs_queue_url, receipt_handles):
+    # DeleteMessageBatch takes at most 10 entries per request
+    failed = []
+    for start in range(0, len(receipt_handles), 10):
+        chunk = receipt_handles[start:start + 10]
+        response = sqs_client.delete_message_batch(
+            QueueUrl=sqs_queue_url,
+            Entries=[{"Id": str(i), "ReceiptHandle": receipt_handle} for i, receipt_handle in enumerate(chunk, start)]
+        )
+        failed.extend(response.get('Failed', []))
+    # Only fail the invocation once every chunk has been tried, so SQS redelivers
+    # just the messages that weren't deleted
+    if failed:
+        raise RuntimeError(f"Failed to delete SQS messages: {failed}")
 
+def lambda_handler(event, context):
+    global SQS_QUEUE_URL
+    init_clients()
+
+    if SQS_QUEUE_URL is None:
+        try:
+            SQS_QUEUE_URL = sqs_client.get_queue_url(QueueName=SQS_QUEUE_NAME)['QueueUrl']
+        except Exception as e:
+            print(f"Error getting SQS Queue URL: {e}")
+            return {
+                'statusCode': 500,
+                'body': json_dumps('SQS queue URL not found.')
+            }
+
+    jobs = []
     for record in event['Records']:
         try:
-            message_body = json.loads(record['body'])
+            message_body = json_loads(record['body'])
             s3_event = message_body['Records'][0]
             source_bucket = s3_event['s3']['bucket']['name']
             source_key = s3_event['s3']['object']['key']
+            source_object = s3_event['s3']['object']
             
-            source_file_name = os.path.basename(source_key)
-            # This logic extracts the path part of the S3 key
-            source_file_path = os.path.dirname(source_key) + '/'
-
-            # Construct the final prompt for the LLM
-            full_prompt = f"{prompt_template}\n\nInput:\nSource File Name: {source_file_name}\nSource File Path: {source_file_path}\nOutput:"
-
-            body = json.dumps({
-                "inputText": full_prompt,
-                "textGenerationConfig": {
-                    "maxTokenCount": 512,
-                    "stopSequences": ["```json", "```"],
-                    "temperature": 0,
-                    "topP": 0.9,
-                }
-            })
-
-            response = bedrock_client.invoke_model(
-                body=body,
-                modelId="amazon.titan-text-express-v1",
-                accept="application/json",
-                contentType="application/json"
-            )
+            # This logic splits the S3 key into its path and file name in one scan
+            head, _, source_file_name = source_key.rpartition('/')
+            source_file_path = head + '/' if head else ''
 
-            response_body = json.loads(response.get('body').read())
-            llm_output_text = response_body.get('results')[0].get('outputText')
-            
-            # Isolate and parse the JSON string from the LLM output
-            json_start = llm_output_text.find('{')
-            json_end = llm_output_text.rfind('}') + 1
-            json_string = llm_output_text[json_start:json_end]
+            jobs.append((record, source_bucket, source_key, source_object, source_file_name, source_file_path))
 
-            llm_output = json.loads(json_string)
-            
-            target_file_path = llm_output['Target File Path'].replace("rtft/", "")
-            target_file_name = llm_output['Target File Name']
-            
-            new_key = target_file_path + target_file_name
-            destination_bucket = os.environ['DESTINATION_BUCKET_NAME']
+        except Exception as e:
+            print(f"Error reading SQS record {record.get('messageId')}: {e}")
 
-            s3_client.copy_object(
-                Bucket=destination_bucket,
-                CopySource={'Bucket': source_bucket, 'Key': source_key},
-                Key=new_key
-            )
-            
-            print(f"File {source_key} copied to {new_key} in {destination_bucket}")
+    # Bedrock is only needed for SAM_ files the deterministic parser can't resolve,
+    # and those are sent together in a single request
+    targets = [transform(name, path) for _, _, _, _, name, path in jobs]
+    pending = [i for i, target in enumerate(targets) if target is None]
+    if pending:
+        try:
+            llm_targets = transform_batch_with_llm([jobs[i][4:] for i in pending])
+            for i, target in zip(pending, llm_targets):
+                targets[i] = target
+        except Exception as e:
+            print(f"Error transforming {len(pending)} files with Bedrock: {e}")
 
-            sqs_client.delete_message(
-                QueueUrl=sqs_queue_url,
-                ReceiptHandle=record['receiptHandle']
-            )
+    # Copies are network-bound, so the batch is copied concurrently
+    results = list(EXECUTOR.map(process_record, jobs, targets))
+
+    receipt_handles = [receipt_handle for receipt_handle, ok in results if ok]
+    delete_messages(SQS_QUEUE_URL, receipt_handles)
 
-        except Exception as e:
-            print(f"Error processing S3 object {source_key}: {e}")
-            
     return {
         'statusCode': 200,
-        'body': json.dumps('Processing complete!')
+        'body': json_dumps('Processing complete!')
     }
\ No newline at end of file
@@ -1,10 +1,38 @@
 import urllib.parse
+import concurrent.futures
 import json
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
+from botocore.exceptions import ClientError
+from s3transfer.manager import TransferManager
+from s3transfer.subscribers import BaseSubscriber
 import os
 import traceback
 
+# RE2 matches in linear time on a DFA with no backtracking. Use it for the
+# filename patterns when the google-re2 wheel is bundled, otherwise stdlib re.
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+# orjson parses and serialises several times faster than the stdlib; fall back
+# to json where its wheels aren't available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
 # CORRECTED: Improved prompt to ensure only JSON is returned, making parsing more reliable.
 prompt_template = """
 Transform the source file info into a JSON object with "Target File Name" and "Target File Path" keys.
@@ -60,34 +88,330 @@ Input: my_report.pdf, samprod-fileingestion/Mock Study 33/
 Output: {"Target File Name": "my_report.pdf", "Target File Path": "rtft/Mock Study 33/unknownvendor/"}
 """
 
-sqs_client = boto3.client('sqs')
-s3_client = boto3.client('s3')
+# Sent along with the prompt when several files are resolved in one request
+batch_instructions = """
+Batch mode: the input is a JSON array of {"name": source file name, "path": source file path} objects.
 
-# Configure Bedrock client with region
-config = Config(
-    region_name=os.environ.get('AWS_REGION', 'us-east-1')
+Your entire response must be ONLY a JSON array with one {"Target File Name", "Target File Path"} object per input, in the same order.
+"""
+
+# Grammar of well-formed ingestion files:
+# SAM_<study>_<env>_<dataset>_<blinding>_<vendor>_<date>.<ext>
+SAM_PATTERN = re.compile(
+    r'^SAM_(?P<study>.+?)_(?:TEST|PROD)_(?P<dataset>[^_]+)_(?P<blinding>BLINDED|UNBLINDED)'
+    r'_(?P<vendor>.+?)_(?P<date>\d{4}(?:[A-Z]{3}|\d{2})\d{2})\.(?P<ext>.+)$'
+)
+
+MONTHS = {
+    'JAN': '01', 'FEB': '02', 'MAR': '03', 'APR': '04', 'MAY': '05', 'JUN': '06',
+    'JUL': '07', 'AUG': '08', 'SEP': '09', 'OCT': '10', 'NOV': '11', 'DEC': '12',
+}
+
+# Known component values, used to pick fields out of names that don't follow the grammar
+STUDY_TOKENS = re.compile(r'(B15-845|ABT-199|M24-064|P23-380)')
+DATASET_TOKENS = re.compile(r'(?:^|_)(DA|RNKIT|MAGEINV|TV)(?:_|\.|$)')
+BLINDING_TOKENS = re.compile(r'(?i)(?:^|_)(UNBLINDED|BLINDED)(?:_|\.|$)')
+VENDOR_TOKENS = re.compile(r'(?:^|_)(UC lab|LBC|EPC|ABBV)(?:_|\.|$)')
+DATE_TOKENS = re.compile(r'(?:^|_)(\d{4}(?:[A-Za-z]{3}|\d{2})\d{2})(?:_|\.|$)')
+
+
+def convert_date(date):
+    # 2023APR18 -> 20230418; dates already in YYYYMMDD pass through
+    month = date[4:-2]
+    if month.isalpha():
+        month = MONTHS.get(month.upper())
+        if month is None:
+            return None
+    return date[:4] + month + date[-2:]
+
+
+def find_token(pattern, text):
+    match = pattern.search(text)
+    return match.group(1) if match else None
+
+
+def build_target(file_name, study, vendor):
+    return {
+        "Target File Name": file_name,
+        "Target File Path": f"rtft/{study or 'unknownstudy'}/{vendor or 'unknownvendor'}/"
+    }
+
+
+def find_study(source_file_name, source_file_path):
+    # The study folder in the source path, otherwise a known study code in the name
+    head, _, folder = source_file_path.rstrip('/').rpartition('/')
+    return (folder if head else None) or find_token(STUDY_TOKENS, source_file_name)
+
+
+def transform(source_file_name, source_file_path):
+    """Map a source file to its target name and path without calling the LLM.
+
+    Returns a dict shaped like the LLM output, or None for a SAM_ file whose
+    blinding status, date or extension can't be found, which is left to Bedrock.
+    """
+    # Anything that isn't a SAM_ file keeps its name under the fallback rule, so
+    # skip the SAM_ grammar and field searches entirely
+    if not source_file_name.startswith('SAM_'):
+        return build_target(
+            source_file_name,
+            find_study(source_file_name, source_file_path),
+            find_token(VENDOR_TOKENS, source_file_name)
+        )
+
+    match = SAM_PATTERN.match(source_file_name)
+    if match:
+        date = convert_date(match.group('date'))
+        if date:
+            return build_target(
+                f"{match.group('blinding')}_{match.group('dataset')}_{date}.{match.group('ext')}",
+                match.group('study'),
+                match.group('vendor')
+            )
+
+    # Fields are missing or out of order: search for the known values instead
+    blinding = find_token(BLINDING_TOKENS, source_file_name)
+    date = find_token(DATE_TOKENS, source_file_name)
+    date = convert_date(date) if date else None
+    # With more than one dot there's no telling where the extension starts
+    # (e.g. .tar.gz), so leave those to Bedrock rather than drop part of it
+    if not (blinding and date) or source_file_name.count('.') != 1:
+        return None
+    ext = source_file_name.rpartition('.')[2]
+    dataset = find_token(DATASET_TOKENS, source_file_name) or 'unknowndataset'
+    return build_target(
+        f"{blinding.upper()}_{dataset}_{date}.{ext}",
+        find_study(source_file_name, source_file_path),
+        find_token(VENDOR_TOKENS, source_file_name)
+    )
+
+
+# Clients are created on first use and reused across invocations. Building one
+# loads its botocore service model, so Bedrock is only paid for when it's needed.
+sqs_client = None
+s3_client = None
+transfer_manager = None
+bedrock_client = None
+
+# Sized for the concurrent copy step, with keep-alive so pooled TLS connections get reused
+client_config = Config(
+    max_pool_connections=64,
+    retries={'mode': 'adaptive', 'max_attempts': 3},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=10
 )
 
-bedrock_client = boto3.client(
-    service_name='bedrock-runtime',
-    config=config
+# Small objects are copied with a single CopyObject; past the threshold the
+# transfer manager switches to a parallel multipart copy (UploadPartCopy)
+transfer_config = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=16
 )
 
-def lambda_handler(event, context):
-    # Validate required environment variables
-    required_env_vars = ['SQS_QUEUE_NAME', 'DESTINATION_BUCKET_NAME']
-    missing_vars = [var for var in required_env_vars if var not in os.environ]
-    if missing_vars:
-        error_msg = f"Missing required environment variables: {', '.join(missing_vars)}"
-        print(error_msg)
-        return {'statusCode': 500, 'body': json.dumps(error_msg)}
-    
+class ProvideSizeSubscriber(BaseSubscriber):
+    """Hands the object size (and ETag) from the S3 event to the transfer manager,
+    so a single-request copy doesn't need a HeadObject first."""
+
+    def __init__(self, size, etag=None):
+        self.size = size
+        self.etag = etag
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+        # Older s3transfer releases don't track the ETag
+        if self.etag and hasattr(future.meta, 'provide_object_etag'):
+            future.meta.provide_object_etag(self.etag)
+
+def init_clients():
+    global sqs_client, s3_client, transfer_manager
+    if sqs_client is None:
+        sqs_client = boto3.client('sqs', config=client_config)
+    if s3_client is None:
+        s3_client = boto3.client('s3', config=client_config)
+    if transfer_manager is None:
+        transfer_manager = TransferManager(s3_client, transfer_config)
+
+# Configure Bedrock client with region; generating text takes longer than
+# the S3/SQS calls, so it gets a longer read timeout
+config = Config(
+    region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+    read_timeout=60
+)
+
+def get_bedrock_client():
+    global bedrock_client
+    if bedrock_client is None:
+        bedrock_client = boto3.client(
+            service_name='bedrock-runtime',
+            config=client_config.merge(config)
+        )
+    return bedrock_client
+
+# "optimized" asks Bedrock for latency-optimized inference in place of prompt caching;
+# the default "standard" keeps the cached system prompt
+BEDROCK_LATENCY = os.environ.get('BEDROCK_LATENCY', 'standard').strip()
+
+# Shared by the copy step; botocore clients are thread-safe
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+
+# Validate required environment variables once, so a misconfigured function
+# fails its cold start instead of every invocation
+required_env_vars = ['SQS_QUEUE_NAME', 'DESTINATION_BUCKET_NAME']
+missing_vars = [var for var in required_env_vars if not os.environ.get(var, '').strip()]
+if missing_vars:
+    raise RuntimeError(f"Missing required environment variables: {', '.join(missing_vars)}")
+if BEDROCK_LATENCY not in ('standard', 'optimized'):
+    raise RuntimeError(f"BEDROCK_LATENCY must be 'standard' or 'optimized', got {BEDROCK_LATENCY!r}")
+
+# Strip whitespace from the queue and bucket names to avoid invalid name errors
+SQS_QUEUE_NAME = os.environ['SQS_QUEUE_NAME'].strip()
+DESTINATION_BUCKET = os.environ['DESTINATION_BUCKET_NAME'].strip()
+
+# Looked up by the first invocation, and retried by later ones if that fails
+SQS_QUEUE_URL = None
+
+# With SnapStart, init runs once per published version and is restored from a
+# snapshot on cold start, so build the clients and resolve the queue URL here
+# instead of on the first invocation. A failed lookup is left to the handler.
+if os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'snap-start':
+    init_clients()
+    try:
+        SQS_QUEUE_URL = sqs_client.get_queue_url(QueueName=SQS_QUEUE_NAME)['QueueUrl']
+    except Exception as e:
+        print(f"Error getting SQS Queue URL during init: {e}")
+
+def transform_batch_with_llm(files):
+    """Resolve several (source_file_name, source_file_path) pairs with one Bedrock call.
+
+    Returns the target dicts in the same order as files.
+    """
+    inputs = [{"name": name, "path": path} for name, path in files]
+
+    # The static instructions go in the system block ahead of a cache point so
+    # Bedrock can reuse their prefill; only the file details change per call.
+    # Bedrock rejects cache points on latency-optimized requests, so it's one or the other.
+    system = [
+        {"text": prompt_template},
+        {"text": batch_instructions}
+    ]
+    if BEDROCK_LATENCY == 'optimized':
+        request_options = {"performanceConfig": {"latency": "optimized"}}
+    else:
+        system.append({"cachePoint": {"type": "default"}})
+        request_options = {}
+
+    print(f"DEBUG: Invoking Bedrock model for {len(files)} files...")
+    response = get_bedrock_client().converse(
+        modelId="arn:aws:bedrock:us-east-1:419835568062:application-inference-profile/out5xci4bakz",
+        system=system,
+        messages=[
+            {"role": "user", "content": [{"text": json_dumps(inputs)}]}
+        ],
+        inferenceConfig={
+            # Each target is ~60-80 tokens
+            "maxTokens": 96 * len(files),
+            "temperature": 0.0,
+            "topP": 1
+        },
+        **request_options
+    )
+
+    content = response['output']['message']['content']
+    if content:
+        llm_output_text = content[0]['text']
+    else:
+        raise ValueError(f"Unexpected response structure from Bedrock: {json_dumps(response['output'])}")
+
+    print(f"DEBUG: Prompt cache read tokens: {response['usage'].get('cacheReadInputTokens', 0)}")
+    print(f"DEBUG: Raw LLM output text: {llm_output_text}")
+    targets = json_loads(llm_output_text)
+    # A lone object or a short list would otherwise be zipped against the wrong files
+    if not isinstance(targets, list) or len(targets) != len(files):
+        raise ValueError(f"Expected a list of {len(files)} transformations from Bedrock, got: {json_dumps(targets)}")
+    for target in targets:
+        if not (isinstance(target, dict)
+                and isinstance(target.get('Target File Name'), str)
+                and isinstance(target.get('Target File Path'), str)):
+            raise ValueError(f"Malformed transformation from Bedrock: {json_dumps(target)}")
+    return targets
+
+def process_record(job, target):
+    """Copy one resolved file to the destination bucket.
+
+    Returns (receipt_handle, ok) so the caller can delete the messages that succeeded.
+    """
+    record, source_bucket, source_key, source_object, _, _ = job
+    if target is None:
+        return record.get('receiptHandle'), False
     try:
-        sqs_queue_url = sqs_client.get_queue_url(QueueName=os.environ['SQS_QUEUE_NAME'])['QueueUrl']
+        target_file_path = target['Target File Path'].replace("rtft/", "")
+        target_file_name = target['Target File Name']
+
+        new_key = os.path.join(target_file_path, target_file_name)
+
+        print(f"DEBUG: Copying from s3://{source_bucket}/{source_key} to s3://{DESTINATION_BUCKET}/{new_key}")
+        # Keep the source metadata, and only copy the version this event is about
+        extra_args = {'MetadataDirective': 'COPY'}
+        if source_object.get('eTag'):
+            extra_args['CopySourceIfMatch'] = source_object['eTag']
+
+        # Below the threshold the copy is a single CopyObject, so the size from the
+        # event is all it needs. Larger objects are left to s3transfer's own
+        # HeadObject, which supplies the metadata for the multipart upload.
+        source_size = source_object.get('size')
+        subscribers = None
+        if source_size is not None and source_size < transfer_config.multipart_threshold:
+            subscribers = [ProvideSizeSubscriber(source_size, source_object.get('eTag'))]
+
+        transfer_manager.copy(
+            copy_source={'Bucket': source_bucket, 'Key': source_key},
+            bucket=DESTINATION_BUCKET,
+            key=new_key,
+            extra_args=extra_args,
+            subscribers=subscribers
+        ).result()
+
+        print(f"File {source_key} copied to {new_key} in {DESTINATION_BUCKET}")
+        return record.get('receiptHandle'), True
+
     except Exception as e:
-        print(f"Error getting SQS Queue URL: {e}")
-        return {'statusCode': 500, 'body': json.dumps('SQS queue URL not found.')}
+        # The source was overwritten after this event; the newer version's own event copies it.
+        # CopyObject reports this as PreconditionFailed, the HeadObject before a multipart copy as a bare 412
+        if isinstance(e, ClientError) and e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 412:
+            print(f"Skipping {source_key}: it changed after this event was sent")
+            return record.get('receiptHandle'), True
+        print(f"Error processing message: {e}")
+        traceback.print_exc()
+        return record.get('receiptHandle'), False
+
+def delete_messages(sqs_queue_url, receipt_handles):
+    # DeleteMessageBatch takes at most 10 entries per request
+    failed = []
+    for start in range(0, len(receipt_handles), 10):
+        chunk = receipt_handles[start:start + 10]
+        response = sqs_client.delete_message_batch(
+            QueueUrl=sqs_queue_url,
+            Entries=[{"Id": str(i), "ReceiptHandle": receipt_handle} for i, receipt_handle in enumerate(chunk, start)]
+        )
+        failed.extend(response.get('Failed', []))
+    # Only fail the invocation once every chunk has been tried, so SQS redelivers
+    # just the messages that weren't deleted
+    if failed:
+        raise RuntimeError(f"Failed to delete SQS messages: {failed}")
+
+def lambda_handler(event, context):
+    global SQS_QUEUE_URL
+    init_clients()
 
+    if SQS_QUEUE_URL is None:
+        try:
+            SQS_QUEUE_URL = sqs_client.get_queue_url(QueueName=SQS_QUEUE_NAME)['QueueUrl']
+        except Exception as e:
+            print(f"Error getting SQS Queue URL: {e}")
+            return {'statusCode': 500, 'body': json_dumps('SQS queue URL not found.')}
+
+    jobs = []
     for record in event['Records']:
         try:
             # Handle both SQS-wrapped S3 events and direct S3 events
@@ -97,7 +421,7 @@ def lambda_handler(event, context):
                 # SQS event: extract S3 event from message body
                 message_body = record.get('body')
                 if message_body:
-                    body_json = json.loads(message_body)
+                    body_json = json_loads(message_body)
                     # S3 event notification structure
                     s3_event = body_json['Records'][0]['s3'] if 'Records' in body_json and 's3' in body_json['Records'][0] else None
                 else:
@@ -108,66 +432,37 @@ def lambda_handler(event, context):
 
             source_bucket = s3_event['bucket']['name']
             source_key = urllib.parse.unquote_plus(s3_event['object']['key'])
+            source_object = s3_event['object']
 
-            source_file_name = os.path.basename(source_key)
-            source_file_path = os.path.dirname(source_key) + '/'
-
-            full_prompt = f"{prompt_template}\n\nInput:\nSource File Name: {source_file_name}\nSource File Path: {source_file_path}\nOutput:"
-
-            body_dict = {
-                "anthropic_version": "bedrock-2023-05-31",
-                "messages": [
-                    {"role": "user", "content": full_prompt}
-                ],
-                "max_tokens": 512,
-                "temperature": 0.0,
-                "top_p": 0.9
-            }
-            body = json.dumps(body_dict)
-
-            print("DEBUG: Invoking Bedrock model...")
-            response = bedrock_client.invoke_model(
-                body=body,
-                modelId="arn:aws:bedrock:us-east-1:419835568062:application-inference-profile/out5xci4bakz",
-                accept="application/json",
-                contentType="application/json"
-            )
-
-            response_body = json.loads(response['body'].read().decode('utf-8'))
-            if 'content' in response_body and response_body['content']:
-                llm_output_text = response_body['content'][0]['text']
-            else:
-                raise ValueError(f"Unexpected response structure from Bedrock: {json.dumps(response_body)}")
-
-            print(f"DEBUG: Raw LLM output text: {llm_output_text}")
-            llm_output = json.loads(llm_output_text)
+            head, _, source_file_name = source_key.rpartition('/')
+            source_file_path = head + '/' if head else ''
 
-            target_file_path = llm_output['Target File Path'].replace("rtft/", "")
-            target_file_name = llm_output['Target File Name']
+            jobs.append((record, source_bucket, source_key, source_object, source_file_name, source_file_path))
 
-            new_key = os.path.join(target_file_path, target_file_name)
-            # Strip whitespace from bucket name to avoid invalid bucket errors
-            destination_bucket = os.environ['DESTINATION_BUCKET_NAME'].strip()
+        except Exception as e:
+            print(f"Error reading message: {e}")
+            traceback.print_exc()
 
-            print(f"DEBUG: Copying from s3://{source_bucket}/{source_key} to s3://{destination_bucket}/{new_key}")
-            s3_client.copy_object(
-                Bucket=destination_bucket,
-                CopySource={'Bucket': source_bucket, 'Key': source_key},
-                Key=new_key
-            )
+    # Bedrock is only needed for SAM_ files the deterministic parser can't resolve,
+    # and those are sent together in a single request
+    targets = [transform(name, path) for _, _, _, _, name, path in jobs]
+    pending = [i for i, target in enumerate(targets) if target is None]
+    if pending:
+        try:
+            llm_targets = transform_batch_with_llm([jobs[i][4:] for i in pending])
+            for i, target in zip(pending, llm_targets):
+                targets[i] = target
+        except Exception as e:
+            print(f"Error transforming {len(pending)} files with Bedrock: {e}")
+            traceback.print_exc()
 
-            print(f"File {source_key} copied to {new_key} in {destination_bucket}")
+    # Copies are network-bound, so the batch is copied concurrently
+    results = list(EXECUTOR.map(process_record, jobs, targets))
 
-            sqs_client.delete_message(
-                QueueUrl=sqs_queue_url,
-                ReceiptHandle=record['receiptHandle']
-            )
+    receipt_handles = [receipt_handle for receipt_handle, ok in results if ok and receipt_handle]
+    delete_messages(SQS_QUEUE_URL, receipt_handles)
 
-        except Exception as e:
-            print(f"Error processing message: {e}")
-            traceback.print_exc()
-            
     return {
         'statusCode': 200,
-        'body': json.dumps('Processing complete!')
+        'body': json_dumps('Processing complete!')
     }